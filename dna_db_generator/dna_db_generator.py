@@ -6,119 +6,219 @@ Authors: Kristóf Balázs, Stefanos Kypritidis, Otto Wantland, Nima Kamali Lasse
 '''
 
 # Library Imports
-import pandas as pd
+import numpy as np
+import gzip
+import io
+import mmap
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import compress, repeat
+
+# Optional parallel gzip decompression, falls back to the standard gzip module
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
 
 
 # File paths
 sources_paths = []
 output_paths = []
 for file in os.listdir('files/fastqs'):
-    if file.endswith(".fastq"):
+    if file.endswith((".fastq", ".fastq.gz")):
         sources_paths.append(os.path.join("files/fastqs", file))
 
 
-# Identifies the type of sequence as either DNA, Kmer or QKmer
-def seq_sorter(sequence, sequences, dnas, kmers, qkmers):
-    if sequence.find("R") + sequence.find("N") + sequence.find("Y") >= -2:
-        if len(sequence) <= 32:
-            sequences[sequence] = 'qkmer'
-            qkmers.append(sequence)
-        else:
-            pass
-    else:
-        if len(sequence) <= 32:
-            sequences[sequence] = 'kmer'
-            kmers.append(sequence)
-        else:
-            sequences[sequence] = 'dna'
-            dnas.append(sequence)
-    return sequences, dnas, kmers, qkmers
-
-
-# Read the generated .fastq file and return a list of dna sequences
-def query_parsing(files):
-    sequences = {}
-    dnas = []
-    kmers = []
-    qkmers = []
-    for file in files:
-        with open(file, 'r') as seq:
+# bytes.translate table flagging the ambiguous nucleotides (R, N, Y) that only QKmers can contain
+ambiguous_table = bytes(1 if byte in b"RNY" else 0 for byte in range(256))
+
+
+# Identifies the type of every sequence in a batch as either DNA, Kmer or QKmer and adds
+# it to the matching set
+def seq_sorter(batch, dnas, kmers, qkmers):
+    if not batch:
+        return
+
+    # Scan all the sequences at once as a single byte buffer and map every ambiguous
+    # nucleotide found back to the sequence it belongs to through the sequence end offsets
+    lens = np.fromiter(map(len, batch), dtype=np.int64, count=len(batch))
+    ends = np.cumsum(lens)
+    flags = np.frombuffer(b"".join(batch).translate(ambiguous_table), dtype=np.uint8)
+    ambiguous = np.zeros(len(batch), dtype=bool)
+    ambiguous[np.searchsorted(ends, np.flatnonzero(flags), side='right')] = True
+    short = lens <= 32
+
+    # Ambiguous sequences longer than 32 nucleotides are neither of the three types
+    dnas.update(compress(batch, (~short & ~ambiguous).tolist()))
+    kmers.update(compress(batch, (short & ~ambiguous).tolist()))
+    qkmers.update(compress(batch, (short & ambiguous).tolist()))
+
+
+# Open a gzipped .fastq file in binary mode, decompressing it on the fly with the given
+# number of decoder threads
+def fastq_open(file, threads):
+    if rapidgzip is not None:
+        # RapidgzipFile is a raw stream, without a buffer it would be read line by line one
+        # byte at a time
+        return io.BufferedReader(rapidgzip.open(file, parallelization=threads), buffer_size=1 << 20)
+    return gzip.open(file, 'rb')
+
+
+# Size of the windows plain .fastq files are scanned in, which bounds the scanner's memory
+window_size = 1 << 24
+
+
+# Finds the sequence line of every record in a window of a .fastq file made of whole lines in
+# a single vectorized pass. val tells whether the first line is the sequence of a header that
+# ended the previous window, the returned val whether the line after the window is one.
+def record_scanner(buffer, offset, size, val):
+    data = np.frombuffer(buffer, dtype=np.uint8, count=size, offset=offset)
+
+    # Start and end offsets of every line
+    ends = np.flatnonzero(data == ord("\n"))
+    if data[-1] != ord("\n"):
+        ends = np.append(ends, len(data))
+    starts = np.concatenate(([0], ends[:-1] + 1))
+
+    # Header lines start with "@" and contain "length=", the marker is located by
+    # narrowing the positions of its first byte down one byte at a time
+    marker = np.frombuffer(b"length=", dtype=np.uint8)
+    found = np.flatnonzero(data[:len(data) - len(marker) + 1] == marker[0])
+    for i in range(1, len(marker)):
+        found = found[data[found + i] == marker[i]]
+    has_marker = np.zeros(len(starts), dtype=bool)
+    has_marker[np.searchsorted(ends, found)] = True
+    headers = np.flatnonzero((data[starts] == ord("@")) & has_marker)
+
+    # A header ending the previous window counts as a header on the line before this one
+    if val:
+        headers = np.concatenate(([-1], headers))
+
+    # As when reading line by line, a header right after a header is taken as its sequence,
+    # so only every other header of a run of consecutive header lines counts
+    run_starts = np.flatnonzero(np.diff(headers, prepend=-3) != 1)
+    run_lengths = np.diff(run_starts, append=len(headers))
+    run_offsets = np.arange(len(headers)) - np.repeat(run_starts, run_lengths)
+    lines = headers[run_offsets % 2 == 0] + 1
+    val = bool(len(lines) > 0 and lines[-1] == len(starts))
+    lines = lines[lines < len(starts)]
+
+    seq_starts = starts[lines]
+    seq_ends = ends[lines]
+    seq_ends -= (data[seq_ends - 1] == ord("\r")) & (seq_ends > seq_starts)
+    seq_starts += offset
+    seq_ends += offset
+    return [buffer[start:end] for start, end in zip(seq_starts.tolist(), seq_ends.tolist())], val
+
+
+# Read a single .fastq file and return its unique sequences sorted by type
+def file_parsing(file, threads):
+    dnas = set()
+    kmers = set()
+    qkmers = set()
+    if file.endswith(".gz"):
+        batch = []
+        with fastq_open(file, threads) as seq:
             val = False
-            n = 0
-            for line in seq.read().splitlines():
+            # Stream the decompressed file line by line and sort the sequences in bounded batches
+            for line in seq:
                 if val:
-                    sequences, dnas, kmers, qkmers = seq_sorter(line, sequences, dnas, kmers, qkmers)
+                    batch.append(line.rstrip(b"\r\n"))
                     val = False
-                else:
-                    if line.startswith("@") and line.find("length=") >= 0:
-                        val = True
-            seq.close()
-    return sequences, dnas, kmers, qkmers
-
-
-# Reads the full sequence dictionary and creates sql insert files for each kind of data.
-def command_generator(sequence):
-    with (open("files/sql_inserts/dna_inserts.sql", 'w') as dna_file,
-          open('files/sql_inserts/kmer_inserts.sql', 'w') as kmer_file,
-          open('files/sql_inserts/qkmer_inserts.sql', 'w') as qkmer_file):
-        dna_file.truncate(0)
-        kmer_file.truncate(0)
-        qkmer_file.truncate(0)
-
-        dna_file.write("DROP TABLE IF EXISTS DNAS;\n")
-        dna_file.write("CREATE TABLE DNAS (DNA_SEQUENCE DNA_SEQUENCE);\n")
-        dna_file.write("INSERT INTO DNAS (DNA_SEQUENCE) VALUES\n")
-
-        kmer_file.write("DROP TABLE IF EXISTS KMERS;\n")
-        kmer_file.write("CREATE TABLE KMERS (KMER KMER);\n")
-        kmer_file.write("INSERT INTO KMERS (KMER) VALUES\n")
-
-        qkmer_file.write("DROP TABLE IF EXISTS QKMERS;\n")
-        qkmer_file.write("CREATE TABLE QKMERS (QKMER QKMER);\n")
-        qkmer_file.write("INSERT INTO QKMERS (QKMER) VALUES\n")
-
-        first_dna = True
-        first_kmer = True
-        first_qkmer = True
-
-        for seq, type in sequence.items():
-            if type == 'dna':
-                if first_dna:
-                    dna_file.write(f"('{seq}')\n")
-                    first_dna = False
-                else:
-                    dna_file.write(f",('{seq}')\n")
-            elif type == 'kmer':
-                if first_kmer:
-                    kmer_file.write(f"('{seq}')\n")
-                    first_kmer = False
-                else:
-                    kmer_file.write(f",('{seq}')\n")
-            elif type == 'qkmer':
-                if first_qkmer:
-                    qkmer_file.write(f"('{seq}')\n")
-                    first_qkmer = False
-                else:
-                    qkmer_file.write(f",('{seq}')\n")
+                    if len(batch) >= 1 << 16:
+                        seq_sorter(batch, dnas, kmers, qkmers)
+                        batch = []
+                # Slice comparison and "in" avoid two method calls on every line
+                elif line[:1] == b"@" and b"length=" in line:
+                    val = True
+        seq_sorter(batch, dnas, kmers, qkmers)
+    elif os.path.getsize(file) > 0:
+        # Scan the file straight from the page cache through a read-only memory map
+        with open(file, 'rb') as seq, mmap.mmap(seq.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            # Let the kernel know the file is read sequentially so it reads ahead of the scanner
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            # Scan and sort the file one window at a time, each window is cut after the last
+            # line ending it holds, or after the first one when a line is longer than a window
+            val = False
+            start = 0
+            while start < len(mapped):
+                end = len(mapped)
+                if start + window_size < end:
+                    end = mapped.rfind(b"\n", start, start + window_size) + 1
+                    if end == 0:
+                        end = mapped.find(b"\n", start + window_size) + 1 or len(mapped)
+                batch, val = record_scanner(mapped, start, end - start, val)
+                seq_sorter(batch, dnas, kmers, qkmers)
+                start = end
+    return dnas, kmers, qkmers
+
+
+# Read the generated .fastq files in parallel and write the unique dna sequences of each type
+# into its .csv file, one sequence per line, as soon as each .fastq file is parsed
+def query_parsing(files):
+    # Each .csv file has its own writer thread. The new sequences are joined here into a single
+    # chunk and the thread only runs its write call, which releases the GIL, so the three files
+    # are written concurrently with each other and with the handling of the next results.
+    with (open("files/csv_files/dna.csv", 'wb') as dna_file,
+          open("files/csv_files/kmer.csv", 'wb') as kmer_file,
+          open("files/csv_files/qkmer.csv", 'wb') as qkmer_file,
+          ThreadPoolExecutor(max_workers=1) as dna_writer,
+          ThreadPoolExecutor(max_workers=1) as kmer_writer,
+          ThreadPoolExecutor(max_workers=1) as qkmer_writer):
+        # Sequences already written to each .csv file, so duplicates across files are skipped
+        written = (set(), set(), set())
+        outputs = ((dna_file, dna_writer), (kmer_file, kmer_writer), (qkmer_file, qkmer_writer))
+        writes = [None, None, None]
+        # Every file is parsed by its own worker process while the previous results are written,
+        # the cores are shared between the gzip decoders of the files parsed at the same time
+        workers = os.cpu_count()
+        threads = max(1, workers // max(1, min(workers, len(files))))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for file_sets in executor.map(file_parsing, files, repeat(threads), chunksize=1):
+                for i, (csv_file, writer) in enumerate(outputs):
+                    file_seqs = file_sets[i]
+                    file_seqs -= written[i]
+                    written[i].update(file_seqs)
+                    if not file_seqs:
+                        continue
+                    if b"" in file_seqs:
+                        # COPY loads an empty csv row as NULL, so the empty sequence is quoted
+                        file_seqs.discard(b"")
+                        chunk = b'""\n' + (b"\n".join(file_seqs) + b"\n" if file_seqs else b"")
+                    else:
+                        chunk = b"\n".join(file_seqs) + b"\n"
+                    # At most one chunk per file waits for the disk, and write errors surface
+                    if writes[i] is not None:
+                        writes[i].result()
+                    writes[i] = writer.submit(csv_file.write, chunk)
+        for write in writes:
+            if write is not None:
+                write.result()
+
+
+# Creates the sql files that create the table of each kind of data and load its .csv file
+# with COPY.
+def command_generator():
+    tables = (
+        ("dna", "DNAS", "DNA_SEQUENCE", "DNA_SEQUENCE"),
+        ("kmer", "KMERS", "KMER", "KMER"),
+        ("qkmer", "QKMERS", "QKMER", "QKMER"),
+    )
+    for name, table, column, type in tables:
+        # COPY reads the file on the database server, so it needs its absolute path
+        source = os.path.abspath(f"files/csv_files/{name}.csv").replace("'", "''")
+        with open(f"files/sql_inserts/{name}_inserts.sql", 'w') as sql_file:
+            sql_file.write(f"DROP TABLE IF EXISTS {table};\n")
+            sql_file.write(f"CREATE TABLE {table} ({column} {type});\n")
+            sql_file.write(f"COPY {table} ({column}) FROM '{source}' WITH (FORMAT csv);\n")
 
 
 # Main
 def main():
-    seq, dna, kmer, qkmer = query_parsing(sources_paths)
-    command_generator(seq)
-
-    # Export sequence dictionary into a different .csv file for each data type
-    pd_dna =  pd.DataFrame(dna, columns=['SEQUENCE'])
-    filename = f"files/csv_files/dna.csv"
-    pd_dna.to_csv(filename, index=False, header=False)
-
-    pd_kmer =  pd.DataFrame(kmer, columns=['SEQUENCE'])
-    filename = f"files/csv_files/kmer.csv"
-    pd_kmer.to_csv(filename, index=False, header=False)
+    query_parsing(sources_paths)
+    command_generator()
 
-    pd_qkmer =  pd.DataFrame(qkmer, columns=['SEQUENCE'])
-    filename = f"files/csv_files/qkmer.csv"
-    pd_qkmer.to_csv(filename, index=False, header=False)
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
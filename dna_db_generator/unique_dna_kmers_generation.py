@@ -1,25 +1,38 @@
 import csv
-import random
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
-def sliding_window(sequence, k):
-    """generate k-mers of size k from the given DNA sequence."""
-    return [sequence[i:i+k] for i in range(len(sequence) - k + 1)]
+# 2-bit code of each nucleotide, any other character is marked with 255
+BASE_CODES = np.full(256, 255, dtype=np.uint8)
+BASE_CODES[np.frombuffer(b"ACGT", dtype=np.uint8)] = np.arange(4, dtype=np.uint8)
+
+# weight of each position in a packed k-mer (4^31 ... 4^0), a k-mer uses the last k of them
+POSITION_WEIGHTS = np.uint64(4) ** np.arange(31, -1, -1, dtype=np.uint64)
+
+# k-mers up to this size are deduplicated in a seen-flag table indexed by the packed value (4^k flags);
+# the tables for k = 1..12 take about 22 MB, allocated up front whatever the input size
+DENSE_MAX_K = 12
+
+def sliding_window(codes, k):
+    """generate the 2-bit packed k-mers of size k from the given encoded DNA sequence."""
+    # zero-copy (n-k+1, k) view of all the windows, packed with a single product
+    return sliding_window_view(codes, k) @ POSITION_WEIGHTS[-k:]
 
 def process_dna_sequences(input_file, output_file, max_rows=100_000_000):
     """take DNA sequences from the CSV file and save unique k-mers"""
-    with open(input_file, mode='r') as infile, open(output_file, mode='w', newline='') as outfile:
+    with open(input_file, mode='r') as infile, open(output_file, mode='wb', buffering=1 << 20) as outfile:
         reader = csv.reader(infile)
-        writer = csv.writer(outfile)
 
-        unique_kmers = set()
+        # packed k-mers of different sizes can share the same value, so there is one table/set per k
+        unique_kmers = {k: np.zeros(4 ** k, dtype=bool) if k <= DENSE_MAX_K else set()
+                        for k in range(1, 33)}
         row_count = 0
 
         next(reader)  # skip header
-        
+
+        # read all the sequences first, so that every k can be drawn in a single call
+        dna_sequences = []
         for row in reader:
-            if row_count >= max_rows:
-                break
-            
             dna_sequence = row[0].strip()
             dna_length = len(dna_sequence)
 
@@ -28,20 +41,44 @@ def process_dna_sequences(input_file, output_file, max_rows=100_000_000):
                 print(f"Skipping invalid DNA sequence: {dna_sequence}")
                 continue
 
-            # generate random k (1-32) + validate against DNA length
-            k = random.randint(1, min(32, dna_length))
+            dna_sequences.append(dna_sequence)
+
+        # generate random k (1-32) for every sequence + validate against DNA length
+        dna_lengths = np.fromiter(map(len, dna_sequences), dtype=np.int64, count=len(dna_sequences))
+        ks = np.random.default_rng().integers(1, np.minimum(32, dna_lengths), endpoint=True)
+
+        for dna_sequence, k in zip(dna_sequences, ks.tolist()):
+            if row_count >= max_rows:
+                break
+
+            # k-mers are packed 2 bits per nucleotide, so only A, C, G and T are allowed
+            dna_bytes = dna_sequence.encode()
+            codes = BASE_CODES[np.frombuffer(dna_bytes, dtype=np.uint8)]
+            if (codes == 255).any():
+                print(f"Skipping invalid DNA sequence: {dna_sequence}")
+                continue
 
-            # generate k-mers
-            kmers = sliding_window(dna_sequence, k)
+            # generate packed k-mers and keep the ones not seen before, up to max_rows,
+            # along with a position they start at in the sequence
+            packed = sliding_window(codes.astype(np.uint64), k)
+            seen = unique_kmers[k]
+            if k <= DENSE_MAX_K:
+                # vectorized lookup in the table, then the first position of each new k-mer
+                positions = np.flatnonzero(~seen[packed])
+                new_kmers, first = np.unique(packed[positions], return_index=True)
+                new_kmers = new_kmers[:max_rows - row_count]
+                positions = positions[first][:max_rows - row_count].tolist()
+                seen[new_kmers] = True
+            else:
+                kmers = dict(zip(packed.tolist(), range(len(packed))))
+                new_kmers = list(kmers.keys() - seen)[:max_rows - row_count]
+                positions = [kmers[kmer] for kmer in new_kmers]
+                seen.update(new_kmers)
+            row_count += len(new_kmers)
 
-            # add unique k-mers to the set
-            for kmer in kmers:
-                if kmer not in unique_kmers:
-                    unique_kmers.add(kmer)
-                    writer.writerow([kmer])
-                    row_count += 1
-                    if row_count >= max_rows:
-                        break
+            # single column output, so the k-mer bytes are written directly without the csv module
+            if positions:
+                outfile.write(b"\n".join([dna_bytes[i:i+k] for i in positions]) + b"\n")
 
 input_csv = "files/csv_files/dnas.csv"
 output_csv = "files/csv_files/unique_dna_kmers.csv"